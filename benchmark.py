@@ -0,0 +1,95 @@
+"""
+Benchmark for API.generate_into against the plain generate iterator.
+
+Feeds a fake SSE stream into an OS pipe and counts write syscalls and CPU time per token.
+No network requests are made. Results are printed and written to bench_output.txt.
+"""
+
+import json
+import os
+from time import process_time
+
+from scripts.API import API
+from scripts import parse_chunk
+
+TOKENS: int = 5000
+RUNS: int = 3
+
+LINES = [
+    b"data: " + json.dumps({"choices": [{"delta": {"content": f" tok{i}"}}]}).encode("utf-8")
+    for i in range(TOKENS)
+] + [b"data: [DONE]"]
+
+class FakeAPI(API):
+
+    """
+    API whose generate replays LINES instead of talking to JAI.
+    """
+
+    def __init__(self) -> None:
+        pass
+
+    def generate(self, messages, **kwargs):
+        yield from LINES
+
+class CountingSink():
+
+    """
+    Unbuffered binary sink on top of a file descriptor. Every write() is exactly one os.write syscall.
+    """
+
+    def __init__(self, fd: int) -> None:
+
+        self.fd: int = fd
+        self.writes: int = 0
+
+    def write(self, data: bytes) -> None:
+
+        self.writes += 1
+        os.write(self.fd, data)
+
+    def flush(self) -> None:
+        pass
+
+def run_iterator(api: API, sink: CountingSink) -> None:
+
+    # what consumers do today: one write + flush per SSE line
+    for chunk in api.generate(None, stream=True):
+
+        sink.write(parse_chunk(chunk).encode("utf-8"))
+        sink.flush()
+
+def run_generate_into(api: API, sink: CountingSink) -> None:
+
+    api.generate_into(sink, None)
+
+def main() -> None:
+
+    api = FakeAPI()
+    results = []
+
+    for run in range(RUNS):
+
+        for name, fn in (("iterator", run_iterator), ("generate_into", run_generate_into)):
+
+            # the pipe buffer (64 KiB on Linux) holds the whole fake stream, so writes never block
+            r, w = os.pipe()
+            sink = CountingSink(w)
+
+            started = process_time()
+            fn(api, sink)
+            cpu = process_time() - started
+
+            os.close(r)
+            os.close(w)
+
+            results.append(f"run {run + 1} {name:14s} write syscalls={sink.writes:5d} cpu/token={cpu / TOKENS * 1e6:.2f}us")
+
+    with open("bench_output.txt", "w") as f:
+        f.write("\n".join(results) + "\n")
+
+    print("\n".join(results))
+
+if __name__ == "__main__":
+
+    main()
@@ -1,10 +1,20 @@
 """
 This file contains the unofficial API class which is used to interact with JAI in a sleazy way."""
 
-from typing import Generator, Dict, Any
+from typing import Generator, Dict, Any, Optional, Callable
 from random import randint
+from io import TextIOBase, RawIOBase, BufferedIOBase
+from threading import Event, Thread
+from queue import Queue, Empty, Full
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from time import monotonic, sleep
+import asyncio
+import codecs
 
-from . import requests, UserAgent, uuid4, logger, HTTPAdapter, Retry
+from . import requests, UserAgent, uuid4, logger, HTTPAdapter, Retry, parse_chunk
+
+_STREAM_DONE: object = object() # marks the end of the stream between the generate_into worker and its consumer
+_STREAM_QUEUE_SIZE: int = 256 # deltas the worker may run ahead of the sink before it has to wait
 
 class API():
 
@@ -271,3 +281,335 @@ class API():
 
                         print(e.response.text)
                         raise e  # Re-raise the exception if we've exhausted all retries
+
+    def __is_binary_sink(self, sink) -> bool:
+
+        # plain sockets and byte streams want bytes, everything that looks like a text stream wants str
+        if not hasattr(sink, "write") or isinstance(sink, (RawIOBase, BufferedIOBase)):
+            return True
+
+        if isinstance(sink, (TextIOBase, codecs.StreamWriter)):
+            return False
+
+        mode = getattr(sink, "mode", None)
+
+        if isinstance(mode, str):
+            return "b" in mode
+
+        return getattr(sink, "encoding", None) is None
+
+    def __produce(self, messages, kwargs: Dict[str, Any], put: Callable[[Any], bool], stop: Event) -> None:
+
+        # runs in a worker thread. Decodes deltas and hands them to put(), which blocks while the consumer is behind
+        # and returns False once the consumer gave up. Ends with _STREAM_DONE or the exception generate raised.
+        chunks = self.generate(messages, **kwargs)
+
+        try:
+
+            for chunk in chunks:
+
+                if stop.is_set():
+                    return
+
+                delta = parse_chunk(chunk)
+
+                if delta and not put(delta):
+                    return
+
+        except BaseException as e:
+
+            put(e)
+            return
+
+        finally:
+
+            # closes the HTTP stream right away when we stop early
+            chunks.close()
+
+        put(_STREAM_DONE)
+
+    def generate_into(
+            self,
+            sink,
+            messages,
+            flush_bytes: int = 4096,
+            flush_interval: float = 0.05,
+            binary: Optional[bool] = None,
+            **kwargs: Any
+
+    ) -> int:
+
+        """
+        This function is used to stream a response straight into a writable sink instead of yielding one object per SSE line.
+        generate runs in a worker thread. Deltas are buffered and written in batches once flush_bytes bytes are pending
+        or the oldest pending delta is flush_interval seconds old, whether or not another chunk has arrived by then.
+        Whatever is still buffered is written out even if the stream fails halfway.
+
+        This function blocks. For asyncio.StreamWriter use agenerate_into instead.
+
+        :param sink: Where to write to. Sockets without write() are written to with sendall().
+        :type sink: TextIO | BinaryIO | socket.socket
+
+        :param messages: The messages to send to the API.
+        :type messages: list[dict[str, str]]
+
+        :param flush_bytes: Write as soon as this many bytes are pending.
+        :type flush_bytes: int
+
+        :param flush_interval: Write as soon as the oldest pending delta is this many seconds old.
+        :type flush_interval: float
+
+        :param binary: Whether the sink takes UTF-8 bytes (True) or str (False). None guesses from the sink.
+        :type binary: bool | None
+
+        :param kwargs: Passed on to generate (max_tokens, temperature, system_message, ...). Streaming is always on.
+
+        :return: The number of bytes the sink accepted.
+        :rtype: int
+        """
+
+        kwargs["stream"] = True
+
+        if binary is None:
+            binary = self.__is_binary_sink(sink)
+
+        write = sink.write if hasattr(sink, "write") else sink.sendall
+        flush = getattr(sink, "flush", None)
+        raw = isinstance(sink, RawIOBase)
+
+        deltas: Queue = Queue(maxsize=_STREAM_QUEUE_SIZE)
+        stop = Event()
+
+        def put(item) -> bool:
+
+            while not stop.is_set():
+
+                try:
+
+                    deltas.put(item, timeout=0.1)
+                    return True
+
+                except Full:
+                    pass
+
+            return False
+
+        producer = Thread(target=self.__produce, args=(messages, kwargs, put, stop), daemon=True)
+        producer.start()
+
+        pending = []
+        pending_bytes = 0
+        pending_since = None
+        written = 0
+
+        def write_pending() -> None:
+
+            nonlocal pending_bytes, pending_since, written
+
+            # take the batch out of the buffer first so a failing sink never gets it twice
+            data = (b"" if binary else "").join(pending)
+            size = pending_bytes
+
+            pending.clear()
+            pending_bytes = 0
+            pending_since = None
+
+            if raw:
+
+                # raw streams (e.g. unbuffered socket files) may accept only part of the data
+                view = memoryview(data)
+
+                while view:
+
+                    accepted = write(view)
+
+                    if not accepted:
+                        sleep(0.001)
+                        continue
+
+                    view = view[accepted:]
+                    written += accepted
+
+            else:
+
+                write(data)
+                written += size
+
+            if flush is not None: flush()
+
+        finished = False
+
+        try:
+
+            while True:
+
+                try:
+                    item = deltas.get(timeout=None if pending_since is None else max(pending_since + flush_interval - monotonic(), 0))
+                except Empty:
+                    item = None
+
+                if item is _STREAM_DONE:
+                    break
+
+                if isinstance(item, BaseException):
+                    raise item
+
+                if item is not None:
+
+                    encoded = item.encode("utf-8")
+                    pending.append(encoded if binary else item)
+                    pending_bytes += len(encoded)
+
+                    # the clock only starts at the first delta, not before create_chat() and get_persona()
+                    if pending_since is None:
+                        pending_since = monotonic()
+
+                if pending and (pending_bytes >= flush_bytes or monotonic() - pending_since >= flush_interval):
+                    write_pending()
+
+            finished = True
+
+        finally:
+
+            stop.set()
+
+            # don't lose text we already received if the stream breaks (HTTP error, Ctrl+C, ...).
+            # After a sink error the buffer is already empty, so the dead sink isn't written to again
+            if pending:
+                write_pending()
+
+            # on errors the worker notices stop and closes the stream by itself, no need to wait for it
+            if finished:
+                producer.join()
+
+        return written
+
+    async def agenerate_into(
+            self,
+            writer,
+            messages,
+            flush_bytes: int = 4096,
+            flush_interval: float = 0.05,
+            **kwargs: Any
+
+    ) -> int:
+
+        """
+        This function is used to stream a response into an asyncio.StreamWriter without blocking the event loop.
+        generate runs in the default executor, the writes and drain() happen on the event loop. Batching works like generate_into.
+        The worker waits while drain() is slow, so a slow reader holds back the stream instead of filling up memory.
+
+        :param writer: Where to write the UTF-8 bytes to.
+        :type writer: asyncio.StreamWriter
+
+        :param messages: The messages to send to the API.
+        :type messages: list[dict[str, str]]
+
+        :param flush_bytes: Write as soon as this many bytes are pending.
+        :type flush_bytes: int
+
+        :param flush_interval: Write as soon as the oldest pending delta is this many seconds old.
+        :type flush_interval: float
+
+        :param kwargs: Passed on to generate (max_tokens, temperature, system_message, ...). Streaming is always on.
+
+        :return: The number of bytes written.
+        :rtype: int
+        """
+
+        kwargs["stream"] = True
+
+        loop = asyncio.get_running_loop()
+        deltas: asyncio.Queue = asyncio.Queue(maxsize=_STREAM_QUEUE_SIZE)
+        stop = Event()
+
+        def put(item) -> bool:
+
+            if stop.is_set():
+                return False
+
+            future = asyncio.run_coroutine_threadsafe(deltas.put(item), loop)
+
+            while not stop.is_set():
+
+                try:
+
+                    future.result(0.1)
+                    return True
+
+                except FutureTimeoutError:
+                    pass
+
+            future.cancel()
+            return False
+
+        def report(future: asyncio.Future) -> None:
+
+            if not future.cancelled() and future.exception() is not None:
+                logger.error(f"Streaming worker failed: {future.exception()!r}")
+
+        producer = loop.run_in_executor(None, self.__produce, messages, kwargs, put, stop)
+        producer.add_done_callback(report)
+
+        pending = []
+        pending_bytes = 0
+        deadline = None
+        written = 0
+        finished = False
+
+        try:
+
+            while True:
+
+                try:
+                    item = await asyncio.wait_for(deltas.get(), None if deadline is None else max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    item = None
+
+                if item is _STREAM_DONE:
+                    break
+
+                if isinstance(item, BaseException):
+                    raise item
+
+                if item is not None:
+
+                    encoded = item.encode("utf-8")
+                    pending.append(encoded)
+                    pending_bytes += len(encoded)
+
+                    if deadline is None:
+                        deadline = loop.time() + flush_interval
+
+                if pending and (pending_bytes >= flush_bytes or loop.time() >= deadline):
+
+                    # take the batch out of the buffer first so a failing drain() never sends it twice
+                    data = b"".join(pending)
+                    size = pending_bytes
+
+                    pending.clear()
+                    pending_bytes = 0
+                    deadline = None
+
+                    writer.write(data)
+                    await writer.drain()
+                    written += size
+
+            finished = True
+
+        finally:
+
+            stop.set()
+
+            # don't lose text we already received if the stream breaks.
+            # After a writer error the buffer is already empty, so the dead writer isn't used again
+            if pending:
+
+                writer.write(b"".join(pending))
+                written += pending_bytes
+                await writer.drain()
+
+            if finished:
+                await producer
+
+        return written
@@ -0,0 +1,425 @@
+"""
+This file contains the Scheduler class which sits in front of API.generate and decides which request may talk to JAI next."""
+
+from typing import Generator, Dict, Any, Optional
+from collections import deque
+from threading import Condition, Thread
+from time import monotonic
+import asyncio
+
+from . import logger
+from .API import API
+
+# priority classes. Lower value = served first.
+PRIORITY_INTERACTIVE: int = 0
+PRIORITY_BATCH: int = 1
+
+class _Ticket():
+
+    """
+    A single queued request waiting for a slot in the shared concurrency budget.
+    """
+
+    def __init__(self, priority: int, tenant: str) -> None:
+
+        self.priority: int = priority
+        self.tenant: str = tenant
+        self.granted: bool = False
+
+class Scheduler():
+
+    """
+    This is the Scheduler class which is used to share a fixed number of concurrent generations between several callers.
+    Requests are served by priority class first (interactive before batch) and round-robin across tenant keys inside a class,
+    so one tenant with a big batch job can't starve everybody else.
+    """
+
+    def __init__(self, _api: API, max_concurrency: int = 2) -> None:
+
+        """
+        This function is used to initialize the Scheduler class.
+
+        :param _api: The API instance that performs the actual requests.
+        :type _api: API
+
+        :param max_concurrency: How many generations may run at the same time.
+        :type max_concurrency: int
+        """
+
+        if max_concurrency < 1:
+
+            raise ValueError("max_concurrency must be at least 1.")
+
+        self.api: API = _api
+        self.max_concurrency: int = max_concurrency
+
+        self.__cond: Condition = Condition()
+        self.__active: int = 0
+
+        # priority -> tenant -> waiting tickets, and priority -> tenant rotation order
+        self.__queues: Dict[int, Dict[str, deque]] = {}
+        self.__rotation: Dict[int, deque] = {}
+
+        # priority -> "served" / "timed_out" -> queue-wait statistics
+        self.__metrics: Dict[int, Dict[str, Dict[str, float]]] = {}
+
+    def __enqueue(self, ticket: _Ticket) -> None:
+
+        tenants = self.__queues.setdefault(ticket.priority, {})
+        rotation = self.__rotation.setdefault(ticket.priority, deque())
+
+        if ticket.tenant not in tenants:
+
+            tenants[ticket.tenant] = deque()
+            rotation.append(ticket.tenant)
+
+        tenants[ticket.tenant].append(ticket)
+
+    def __dequeue(self, ticket: _Ticket) -> None:
+
+        # used when a ticket times out or is interrupted before it got a slot
+        tenants = self.__queues[ticket.priority]
+        tenants[ticket.tenant].remove(ticket)
+
+        if not tenants[ticket.tenant]:
+
+            del tenants[ticket.tenant]
+            self.__rotation[ticket.priority].remove(ticket.tenant)
+
+    def __dispatch(self) -> None:
+
+        # hand out free slots. Must be called while holding self.__cond
+        granted = False
+
+        while self.__active < self.max_concurrency:
+
+            waiting = [p for p in sorted(self.__rotation) if self.__rotation[p]]
+
+            if not waiting:
+                break
+
+            priority = waiting[0]
+            rotation = self.__rotation[priority]
+            tenants = self.__queues[priority]
+
+            tenant = rotation.popleft()
+            ticket = tenants[tenant].popleft()
+
+            # tenant goes to the back of the line if it still has work queued
+            if tenants[tenant]:
+                rotation.append(tenant)
+            else:
+                del tenants[tenant]
+
+            ticket.granted = True
+            self.__active += 1
+            granted = True
+
+        if granted:
+            self.__cond.notify_all()
+
+    def __record_wait(self, priority: int, waited: float, timed_out: bool) -> None:
+
+        # timeouts are kept apart so they don't skew the wait that served requests saw
+        outcomes = self.__metrics.setdefault(priority, {
+            "served": {"count": 0, "total_wait": 0.0, "max_wait": 0.0},
+            "timed_out": {"count": 0, "total_wait": 0.0, "max_wait": 0.0},
+        })
+
+        stats = outcomes["timed_out" if timed_out else "served"]
+
+        stats["count"] += 1
+        stats["total_wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+
+    def acquire(self, priority: int = PRIORITY_INTERACTIVE, tenant: str = "default", queue_timeout: Optional[float] = None) -> float:
+
+        """
+        This function is used to wait for a free slot. Every successful call must be paired with release().
+
+        :param priority: The priority class. Use PRIORITY_INTERACTIVE or PRIORITY_BATCH.
+        :type priority: int
+
+        :param tenant: The fair-share key of the caller.
+        :type tenant: str
+
+        :param queue_timeout: The maximum number of seconds to wait in the queue. None waits forever.
+        :type queue_timeout: float | None
+
+        :return: The number of seconds spent in the queue.
+        :rtype: float
+        """
+
+        ticket = _Ticket(priority, tenant)
+        started = monotonic()
+        deadline = None if queue_timeout is None else started + queue_timeout
+
+        with self.__cond:
+
+            self.__enqueue(ticket)
+            self.__dispatch()
+
+            try:
+
+                while not ticket.granted:
+
+                    remaining = None if deadline is None else deadline - monotonic()
+
+                    if remaining is not None and remaining <= 0:
+
+                        self.__dequeue(ticket)
+                        waited = monotonic() - started
+                        self.__record_wait(priority, waited, timed_out=True)
+
+                        logger.warning(f"Request from tenant '{tenant}' timed out after {waited:.2f}s in the queue.")
+                        raise TimeoutError(f"Queue timeout of {queue_timeout}s exceeded.")
+
+                    self.__cond.wait(remaining)
+
+            except TimeoutError:
+                raise
+
+            except BaseException:
+
+                # interrupted while waiting (KeyboardInterrupt etc.). Don't leave the ticket or its slot behind
+                if ticket.granted:
+
+                    self.__active -= 1
+                    self.__dispatch()
+
+                else:
+                    self.__dequeue(ticket)
+
+                raise
+
+            waited = monotonic() - started
+            self.__record_wait(priority, waited, timed_out=False)
+
+        return waited
+
+    def release(self) -> None:
+
+        """
+        This function is used to give a slot back after a generation finished.
+        """
+
+        with self.__cond:
+
+            if self.__active == 0:
+
+                raise RuntimeError("release() called without a matching acquire().")
+
+            self.__active -= 1
+            self.__dispatch()
+
+    def generate(
+            self,
+            messages,
+            priority: int = PRIORITY_INTERACTIVE,
+            tenant: str = "default",
+            queue_timeout: Optional[float] = None,
+            **kwargs: Any
+
+    ) -> Generator[str, None, None]:
+
+        """
+        This function is used to generate a response through the scheduler. It waits for a slot right away (so a queue timeout is raised
+        by this call, not by the first next()), then returns a generator that behaves exactly like API.generate.
+        The slot is held until the returned generator is exhausted, closed or garbage collected.
+
+        :param messages: The messages to send to the API.
+        :type messages: list[dict[str, str]]
+
+        :param priority: The priority class. Use PRIORITY_INTERACTIVE or PRIORITY_BATCH.
+        :type priority: int
+
+        :param tenant: The fair-share key of the caller.
+        :type tenant: str
+
+        :param queue_timeout: The maximum number of seconds to wait in the queue. None waits forever.
+        :type queue_timeout: float | None
+
+        :param kwargs: Passed on to API.generate (max_tokens, stream, temperature, ...).
+
+        :return: The response.
+        :rtype: Generator[str, None, None]
+        """
+
+        self.acquire(priority, tenant, queue_timeout)
+
+        stream = self.__stream(messages, kwargs)
+
+        # step into the try block so close() / garbage collection releases the slot even if the caller never iterates
+        next(stream)
+
+        return stream
+
+    def __stream(self, messages, kwargs: Dict[str, Any]) -> Generator[str, None, None]:
+
+        try:
+
+            yield None
+            yield from self.api.generate(messages, **kwargs)
+
+        finally:
+
+            self.release()
+
+    def generate_into(
+            self,
+            sink,
+            messages,
+            priority: int = PRIORITY_INTERACTIVE,
+            tenant: str = "default",
+            queue_timeout: Optional[float] = None,
+            **kwargs: Any
+
+    ) -> int:
+
+        """
+        This function is used to run API.generate_into through the scheduler. It waits for a slot and holds it until the reply is written.
+
+        :param sink: Where to write to. See API.generate_into.
+        :type sink: TextIO | BinaryIO | socket.socket
+
+        :param messages: The messages to send to the API.
+        :type messages: list[dict[str, str]]
+
+        :param priority: The priority class. Use PRIORITY_INTERACTIVE or PRIORITY_BATCH.
+        :type priority: int
+
+        :param tenant: The fair-share key of the caller.
+        :type tenant: str
+
+        :param queue_timeout: The maximum number of seconds to wait in the queue. None waits forever.
+        :type queue_timeout: float | None
+
+        :param kwargs: Passed on to API.generate_into (flush_bytes, flush_interval, binary, max_tokens, ...).
+
+        :return: The number of bytes the sink accepted.
+        :rtype: int
+        """
+
+        self.acquire(priority, tenant, queue_timeout)
+
+        try:
+
+            return self.api.generate_into(sink, messages, **kwargs)
+
+        finally:
+
+            self.release()
+
+    async def __aacquire(self, priority: int, tenant: str, queue_timeout: Optional[float]) -> None:
+
+        # acquire() blocks, so wait in a thread of our own instead of the default executor,
+        # which the agenerate_into workers of the requests holding slots need
+        loop = asyncio.get_running_loop()
+        granted: asyncio.Future = loop.create_future()
+
+        def hand_over(error: Optional[BaseException]) -> None:
+
+            if granted.cancelled():
+
+                # the caller was cancelled while queued. The slot it got in the meantime goes straight back
+                if error is None: self.release()
+
+            elif error is None:
+                granted.set_result(None)
+
+            else:
+                granted.set_exception(error)
+
+        def wait() -> None:
+
+            try:
+
+                self.acquire(priority, tenant, queue_timeout)
+                error = None
+
+            except BaseException as e:
+                error = e
+
+            try:
+
+                loop.call_soon_threadsafe(hand_over, error)
+
+            except RuntimeError:
+
+                # event loop is gone already
+                if error is None: self.release()
+
+        Thread(target=wait, daemon=True).start()
+
+        await granted
+
+    async def agenerate_into(
+            self,
+            writer,
+            messages,
+            priority: int = PRIORITY_INTERACTIVE,
+            tenant: str = "default",
+            queue_timeout: Optional[float] = None,
+            **kwargs: Any
+
+    ) -> int:
+
+        """
+        This function is used to run API.agenerate_into through the scheduler without blocking the event loop while queued.
+        The slot is held until the reply is written. Cancelling while queued gives up the place in line.
+
+        :param writer: Where to write the UTF-8 bytes to.
+        :type writer: asyncio.StreamWriter
+
+        :param messages: The messages to send to the API.
+        :type messages: list[dict[str, str]]
+
+        :param priority: The priority class. Use PRIORITY_INTERACTIVE or PRIORITY_BATCH.
+        :type priority: int
+
+        :param tenant: The fair-share key of the caller.
+        :type tenant: str
+
+        :param queue_timeout: The maximum number of seconds to wait in the queue. None waits forever.
+        :type queue_timeout: float | None
+
+        :param kwargs: Passed on to API.agenerate_into (flush_bytes, flush_interval, max_tokens, ...).
+
+        :return: The number of bytes written.
+        :rtype: int
+        """
+
+        await self.__aacquire(priority, tenant, queue_timeout)
+
+        try:
+
+            return await self.api.agenerate_into(writer, messages, **kwargs)
+
+        finally:
+
+            self.release()
+
+    def metrics(self) -> Dict[str, Any]:
+
+        """
+        This function is used to get a snapshot of the queue-wait metrics.
+
+        :return: Active slots, queued requests per priority class and wait statistics per priority class,
+                 split into served and timed-out requests.
+        :rtype: Dict[str, Any]
+        """
+
+        with self.__cond:
+
+            return {
+                "active": self.__active,
+                "max_concurrency": self.max_concurrency,
+                "queued": {p: sum(len(q) for q in tenants.values()) for p, tenants in self.__queues.items()},
+                "wait": {
+                    p: {
+                        outcome: dict(stats, avg_wait=stats["total_wait"] / max(stats["count"], 1))
+                        for outcome, stats in outcomes.items()
+                    }
+                    for p, outcomes in self.__metrics.items()
+                },
+            }
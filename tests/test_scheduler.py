@@ -0,0 +1,291 @@
+"""
+Tests for the Scheduler class. A fake API stands in for JAI so the timing is under our control.
+"""
+
+import asyncio
+import gc
+import threading
+import time
+
+import pytest
+
+from scripts.scheduler import Scheduler, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+
+class FakeAPI():
+
+    """
+    Records the order in which requests got a slot and optionally holds each one for a while.
+    """
+
+    def __init__(self, hold: float = 0.0) -> None:
+
+        self.hold: float = hold
+        self.started: list = []
+        self.lock = threading.Lock()
+
+    def generate(self, messages, **kwargs):
+
+        with self.lock:
+            self.started.append(messages)
+
+        time.sleep(self.hold)
+        yield messages
+
+    def generate_into(self, sink, messages, **kwargs) -> int:
+
+        sink.append((messages, kwargs))
+        return len(messages)
+
+    async def agenerate_into(self, writer, messages, **kwargs) -> int:
+
+        await asyncio.sleep(self.hold)
+        writer.append(messages)
+        return len(messages)
+
+def queued(scheduler: Scheduler) -> int:
+
+    return sum(scheduler.metrics()["queued"].values())
+
+def wait_until(condition, timeout: float = 2.0) -> None:
+
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+
+        assert time.monotonic() < deadline, "condition was never met"
+        time.sleep(0.001)
+
+def consume(scheduler: Scheduler, label: str, priority: int, tenant: str) -> threading.Thread:
+
+    # queue one request from another thread and wait until it's actually in the queue
+    before = queued(scheduler)
+
+    thread = threading.Thread(target=lambda: list(scheduler.generate(label, priority=priority, tenant=tenant)))
+    thread.start()
+
+    wait_until(lambda: queued(scheduler) == before + 1)
+    return thread
+
+def test_max_concurrency_must_be_positive():
+
+    with pytest.raises(ValueError):
+        Scheduler(FakeAPI(), max_concurrency=0)
+
+def test_interactive_first_then_tenants_take_turns():
+
+    api = FakeAPI()
+    scheduler = Scheduler(api, max_concurrency=1)
+
+    # hold the only slot so everything below has to queue
+    scheduler.acquire()
+
+    threads = [
+        consume(scheduler, "A1", PRIORITY_BATCH, "A"),
+        consume(scheduler, "A2", PRIORITY_BATCH, "A"),
+        consume(scheduler, "A3", PRIORITY_BATCH, "A"),
+        consume(scheduler, "B1", PRIORITY_BATCH, "B"),
+        consume(scheduler, "B2", PRIORITY_BATCH, "B"),
+        consume(scheduler, "I", PRIORITY_INTERACTIVE, "C"),
+    ]
+
+    scheduler.release()
+
+    for thread in threads:
+        thread.join()
+
+    assert api.started == ["I", "A1", "B1", "A2", "B2", "A3"]
+    assert scheduler.metrics()["active"] == 0
+
+def test_never_more_than_max_concurrency():
+
+    api = FakeAPI(hold=0.02)
+    scheduler = Scheduler(api, max_concurrency=2)
+    peak = 0
+
+    def watch() -> None:
+
+        nonlocal peak
+
+        while len(api.started) < 8:
+
+            peak = max(peak, scheduler.metrics()["active"])
+            time.sleep(0.001)
+
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+
+    threads = [threading.Thread(target=lambda i=i: list(scheduler.generate(str(i), tenant=str(i % 3)))) for i in range(8)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    watcher.join()
+
+    assert 1 <= peak <= 2
+    assert scheduler.metrics()["active"] == 0
+
+def test_generate_queues_when_called():
+
+    scheduler = Scheduler(FakeAPI(), max_concurrency=1)
+
+    stream = scheduler.generate("x")
+    assert scheduler.metrics()["active"] == 1
+
+    assert list(stream) == ["x"]
+    assert scheduler.metrics()["active"] == 0
+
+def test_queue_timeout_is_raised_by_the_call_and_dequeues():
+
+    scheduler = Scheduler(FakeAPI(), max_concurrency=1)
+    scheduler.acquire()
+
+    with pytest.raises(TimeoutError):
+        scheduler.generate("x", queue_timeout=0.05)
+
+    assert queued(scheduler) == 0
+
+    scheduler.release()
+    assert scheduler.metrics()["active"] == 0
+
+def test_timeouts_do_not_skew_served_wait():
+
+    scheduler = Scheduler(FakeAPI(), max_concurrency=1)
+    scheduler.acquire()
+
+    with pytest.raises(TimeoutError):
+        scheduler.acquire(queue_timeout=0.1)
+
+    scheduler.release()
+
+    wait = scheduler.metrics()["wait"][PRIORITY_INTERACTIVE]
+
+    assert wait["served"]["count"] == 1
+    assert wait["served"]["avg_wait"] < 0.05
+
+    assert wait["timed_out"]["count"] == 1
+    assert wait["timed_out"]["avg_wait"] >= 0.1
+
+def test_interrupted_wait_leaves_nothing_behind(monkeypatch):
+
+    scheduler = Scheduler(FakeAPI(), max_concurrency=1)
+    scheduler.acquire()
+
+    def interrupt(timeout=None):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(scheduler._Scheduler__cond, "wait", interrupt)
+
+    with pytest.raises(KeyboardInterrupt):
+        scheduler.acquire()
+
+    monkeypatch.undo()
+
+    assert queued(scheduler) == 0
+
+    scheduler.release()
+    assert scheduler.metrics()["active"] == 0
+
+def test_close_and_garbage_collection_release_the_slot():
+
+    scheduler = Scheduler(FakeAPI(), max_concurrency=1)
+
+    stream = scheduler.generate("x")
+    stream.close()
+    assert scheduler.metrics()["active"] == 0
+
+    stream = scheduler.generate("x")
+    del stream
+    gc.collect()
+    assert scheduler.metrics()["active"] == 0
+
+def test_release_without_acquire_raises():
+
+    scheduler = Scheduler(FakeAPI())
+
+    with pytest.raises(RuntimeError):
+        scheduler.release()
+
+def test_generate_into_holds_a_slot():
+
+    scheduler = Scheduler(FakeAPI(), max_concurrency=1)
+    seen = []
+
+    class Sink(list):
+
+        def append(self, item) -> None:
+
+            seen.append(scheduler.metrics()["active"])
+            super().append(item)
+
+    sink = Sink()
+
+    assert scheduler.generate_into(sink, "abc", flush_bytes=1) == 3
+    assert sink == [("abc", {"flush_bytes": 1})]
+
+    assert seen == [1]
+    assert scheduler.metrics()["active"] == 0
+
+def test_agenerate_into_waits_without_blocking_the_loop():
+
+    scheduler = Scheduler(FakeAPI(hold=0.05), max_concurrency=1)
+
+    async def main() -> None:
+
+        writer = []
+        ticks = 0
+
+        async def tick() -> None:
+
+            nonlocal ticks
+
+            while True:
+
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+
+        results = await asyncio.gather(
+            scheduler.agenerate_into(writer, "one"),
+            scheduler.agenerate_into(writer, "two"),
+        )
+
+        ticker.cancel()
+
+        assert results == [3, 3]
+        assert sorted(writer) == ["one", "two"]
+        assert ticks > 5
+
+    asyncio.run(main())
+    assert scheduler.metrics()["active"] == 0
+
+def test_agenerate_into_cancelled_while_queued_gives_the_slot_back():
+
+    scheduler = Scheduler(FakeAPI(), max_concurrency=1)
+    scheduler.acquire()
+
+    async def main() -> None:
+
+        task = asyncio.create_task(scheduler.agenerate_into([], "x"))
+
+        while queued(scheduler) == 0:
+            await asyncio.sleep(0.001)
+
+        task.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        # the waiting thread still gets the slot once it frees up and must hand it straight back
+        scheduler.release()
+
+        while scheduler.metrics()["active"]:
+            await asyncio.sleep(0.001)
+
+    asyncio.run(main())
+
+    assert queued(scheduler) == 0
+    assert scheduler.metrics()["active"] == 0